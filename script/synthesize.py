@@ -1,30 +1,136 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import httpx
+import itertools
 import json
+import logging
 import ollama
 import os
-import time
+import random
 import sys
-from typing import List, Dict, Any, Optional
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Dict, Any, Optional, Sequence, Tuple
 from tqdm import tqdm
 
+# orjsonが利用可能ならJSONLの読み書きに使う
+# （C実装でパースが高速、UTF-8バイト列を直接出力するためensure_ascii=False相当が既定）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# モデル一覧キャッシュの保存先とTTL（秒）
+MODEL_CACHE_PATH = os.path.expanduser("~/.cache/ollama_synth/models.json")
+MODEL_CACHE_TTL = 60
+
+# 出力をまとめて書き込む行数（1レコードごとのwriteシステムコールを避ける）
+WRITE_CHUNK_LINES = 1000
+
+# 並列パース時に1タスクへ渡すバイトブロックのサイズ
+PARSE_BLOCK_BYTES = 1 << 20
+
+
+def _json_bytes(obj: Any) -> bytes:
+    """オブジェクトをUTF-8のJSONバイト列へ変換する"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(data: bytes) -> Any:
+    """UTF-8のJSONバイト列をオブジェクトへ変換する"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 class OllamaProcessor:
     """Ollamaを使ってLLMを処理するクラス"""
     
-    def __init__(self, config_path="template_config.json"):
+    def __init__(self, config_path="template_config.json", max_parallel: Optional[int] = None):
         """初期化"""
         # 設定を読み込む
         self.config = self._load_config(config_path)
-        
+
         # 設定から各種パラメータを取得
         self.ollama_settings = self.config.get("ollama_settings", {})
         self.script_settings = self.config.get("script_settings", {})
+
+        # レコードごとに設定を辿らなくて済むよう、ホットパスで使う値は先に取り出しておく
+        self._required_fields = tuple(
+            self.config.get("input_format", {}).get("required_fields", ("id", "role", "text"))
+        )
+        self._multi_turn = bool(
+            self.config.get("multi_turn_conversation", {}).get("enabled", False)
+        )
+        # リクエストオプションも全アイテム共通なので一度だけ取り出す
+        self._request_options = dict(self.ollama_settings.get("request_options", {}))
+
+        # 同時リクエスト数の上限（CLIフラグ > 設定ファイル > CPU数×5 の順で決定）
+        # ネットワークI/O待ちが支配的なワークロードなのでCPU数より大きめが既定
+        if max_parallel is None:
+            max_parallel = self.script_settings.get("max_parallel_requests")
+        if not max_parallel:
+            max_parallel = (os.cpu_count() or 1) * 5
+        self.max_parallel = int(max_parallel)
+        self._sem = asyncio.Semaphore(self.max_parallel)
         
         # APIホストの設定
-        api_host = self.ollama_settings.get("api_host")
+        # api_hosts に複数ノードを指定すると、ワーカーをラウンドロビンで
+        # 各ノードへ割り当てて水平スケールする（api_hostは単一ノードの従来形式）
+        api_hosts = self.ollama_settings.get("api_hosts")
+        if not api_hosts:
+            api_hosts = [self.ollama_settings.get("api_host")]
+        api_host = api_hosts[0]
         if api_host:
             os.environ["OLLAMA_HOST"] = api_host
+        self.api_host = api_host or "http://localhost:11434"
+
+        # 接続プールを共有するHTTP設定
+        # リクエストごとのTCP/TLSハンドシェイクを避けるため、keep-alive接続を
+        # 使い回し、HTTP/2の多重化で1本の接続に複数リクエストを載せる
+        pool_limits = httpx.Limits(
+            max_keepalive_connections=40,
+            max_connections=100,
+            keepalive_expiry=30.0
+        )
+        request_timeout = httpx.Timeout(
+            self.script_settings.get("timeout", 120),
+            connect=10.0
+        )
+        default_headers = {"Accept-Encoding": "gzip, deflate"}
+
+        # モデル一覧取得などに使う同期クライアント
+        self.client = ollama.Client(
+            host=api_host,
+            transport=httpx.HTTPTransport(retries=0, http2=True, limits=pool_limits),
+            timeout=request_timeout,
+            headers=default_headers
+        )
+
+        # チャットリクエストを並行実行するための非同期HTTPクライアント（ホストごとに1つ）。
+        # ollamaクライアントを介さず事前構築したJSONバイト列を直接POSTすることで、
+        # 全リクエスト共通のオプション部分を毎回エンコードし直すコストを省く
+        # （サーバー側の並列数はOLLAMA_NUM_PARALLEL環境変数で設定する）
+        chat_headers = dict(default_headers, **{"Content-Type": "application/json"})
+        self.async_clients = [
+            httpx.AsyncClient(
+                base_url=(host or "http://localhost:11434"),
+                transport=httpx.AsyncHTTPTransport(retries=0, http2=True, limits=pool_limits),
+                timeout=request_timeout,
+                headers=chat_headers
+            )
+            for host in api_hosts
+        ]
+
+        # モデル名・オプションのJSON断片キャッシュ（実行時にモデル名ごとに組み立てる）
+        self._chat_payload_model: Optional[str] = None
+        self._chat_payload_prefix: Optional[bytes] = None
     
     def _load_config(self, config_path: str) -> Dict[str, Any]:
         """設定ファイルを読み込む"""
@@ -62,42 +168,121 @@ class OllamaProcessor:
             print(f"エラー: 設定ファイル {config_path} の形式が不正です。")
             sys.exit(1)
     
-    def read_jsonl(self, file_path: str) -> List[Dict[str, Any]]:
-        """指定されたJSONLファイルを読み込む"""
-        data = []
+    def iter_jsonl(self, file_path: str) -> Iterator[Dict[str, Any]]:
+        """JSONLファイルをパースしたレコードを順に返すイテレータを作る
+
+        ファイル自体はこの時点で開く（存在しないパスはパイプライン起動前に
+        1行のエラーで終了させるため）。読み込みはジェネレータとして行い、
+        ファイル全体をメモリに展開せず大きな入力でもピークメモリを一定に
+        保つ。パース自体は改行境界でそろえたバイトブロック単位でスレッド
+        プールに投げる（orjsonはパース中にGILを解放するため実際に並列化
+        される）。
+        """
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line_num, line in enumerate(tqdm(lines, desc="JSONLファイルを読み込み中"), 1):
-                    if line.strip():
-                        try:
-                            data.append(json.loads(line))
-                        except json.JSONDecodeError:
-                            print(f"警告: {line_num}行目のJSON形式が不正です。スキップします。")
+            f = open(file_path, 'rb')
         except FileNotFoundError:
             print(f"エラー: 入力ファイル {file_path} が見つかりません。")
             sys.exit(1)
-        
-        return data
-    
-    def write_jsonl(self, file_path: str, data: List[Dict[str, Any]]) -> None:
-        """指定されたデータをJSONLファイルに書き込む"""
-        # 出力ディレクトリが存在しない場合は作成
-        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
-            for item in tqdm(data, desc="結果を保存中"):
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+        loads = orjson.loads if orjson is not None else json.loads
+
+        def parse_block(args: Tuple[int, bytes]) -> Tuple[List[Dict[str, Any]], List[int]]:
+            start_line, block = args
+            records = []
+            bad = []
+            for offset, raw in enumerate(block.split(b'\n')):
+                if raw.strip():
+                    try:
+                        records.append(loads(raw))
+                    except ValueError:
+                        bad.append(start_line + offset)
+            return records, bad
+
+        def read_blocks(f) -> Iterator[Tuple[int, bytes]]:
+            # 改行境界でそろえた大きめのバイトブロックを開始行番号付きで返す
+            line_no = 1
+            carry = b''
+            while True:
+                chunk = f.read(PARSE_BLOCK_BYTES)
+                if not chunk:
+                    break
+                chunk = carry + chunk
+                cut = chunk.rfind(b'\n')
+                if cut == -1:
+                    carry = chunk
+                    continue
+                block, carry = chunk[:cut], chunk[cut + 1:]
+                yield line_no, block
+                line_no += block.count(b'\n') + 1
+            if carry:
+                yield line_no, carry
+
+        max_workers = os.cpu_count() or 1
+
+        def generate() -> Iterator[Dict[str, Any]]:
+            # 不正な行は読み込みループ内でprintせず行番号だけ集めて、
+            # 最後にまとめて警告する（大量の不正行でも標準出力がボトルネックにならない）
+            bad_lines: List[int] = []
+            with f:
+                with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                    # 全ブロックを一括submitするとファイル全体を先読みしてしまうので、
+                    # ワーカー数×2だけ先行投入し、結果を順に取り出しながら補充する
+                    block_iter = read_blocks(f)
+                    futures = deque(
+                        ex.submit(parse_block, args)
+                        for args in itertools.islice(block_iter, max_workers * 2)
+                    )
+                    while futures:
+                        records, bad = futures.popleft().result()
+                        nxt = next(block_iter, None)
+                        if nxt is not None:
+                            futures.append(ex.submit(parse_block, nxt))
+                        bad_lines.extend(bad)
+                        yield from records
+
+            if bad_lines:
+                print(f"警告: {len(bad_lines)}行のJSON形式が不正だったためスキップしました"
+                      f"（先頭10件: {bad_lines[:10]}行目）。")
+
+        return generate()
+
+    def _load_done_ids(self, output_path: str) -> set:
+        """既存の出力ファイルから処理済みレコードのIDを集める（レジューム用）"""
+        done = set()
+        loads = orjson.loads if orjson is not None else json.loads
+        try:
+            with open(output_path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            record = loads(line)
+                        except ValueError:
+                            continue
+                        # 出力に紛れ込んだ非オブジェクト行は処理済みとして扱わない
+                        if isinstance(record, dict):
+                            done.add(record.get('id'))
+        except FileNotFoundError:
+            pass
+        return done
+
+    @staticmethod
+    def _prompt_length(item: Dict[str, Any]) -> int:
+        """プロンプト長の近似値（文字数）を返す。形式が不正な場合は0"""
+        try:
+            return sum(len(t) for t in item['text'])
+        except (KeyError, TypeError):
+            return 0
+
+    def _dump_line(self, item: Dict[str, Any]) -> bytes:
+        """1レコードをJSONLの1行（UTF-8バイト列）に変換する"""
+        return _json_bytes(item) + b'\n'
     
     def validate_input(self, item: Dict[str, Any]) -> bool:
         """入力データの形式が正しいか検証する"""
-        required_fields = self.config.get("input_format", {}).get("required_fields", ["id", "role", "text"])
-        
         # 必須フィールドの存在確認
-        for field in required_fields:
-            if field not in item:
-                return False
-        
+        if not all(field in item for field in self._required_fields):
+            return False
+
         # roleとtextが配列形式であることを確認
         if not isinstance(item.get('role'), list) or not item.get('role'):
             return False
@@ -107,20 +292,67 @@ class OllamaProcessor:
         
         return True
     
+    def _load_model_cache(self, host: str) -> Optional[List[str]]:
+        """キャッシュファイルからホストごとのモデル一覧を読み込む（期限切れならNone）"""
+        try:
+            with open(MODEL_CACHE_PATH, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            entry = cache.get(host)
+            if entry and time.time() - entry.get("timestamp", 0) < MODEL_CACHE_TTL:
+                return entry.get("models", [])
+        except (OSError, json.JSONDecodeError):
+            pass
+        return None
+
+    def _save_model_cache(self, host: str, models: List[str]) -> None:
+        """ホストごとのモデル一覧をキャッシュファイルへ保存する"""
+        try:
+            os.makedirs(os.path.dirname(MODEL_CACHE_PATH), exist_ok=True)
+            try:
+                with open(MODEL_CACHE_PATH, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                cache = {}
+            cache[host] = {"timestamp": time.time(), "models": models}
+            with open(MODEL_CACHE_PATH, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+        except OSError:
+            # キャッシュの保存に失敗しても処理は続行できる
+            pass
+
+    def _model_in_list(self, model_name: str, available_models: List[str]) -> bool:
+        """完全一致または前方一致（タグ付き）でモデル名を照合する"""
+        for available in available_models:
+            if model_name == available or available.startswith(f"{model_name}:"):
+                return True
+        return False
+
     def check_model_availability(self, model_name: str) -> bool:
         """指定されたモデルが利用可能かチェックする"""
+        # キャッシュが有効ならHTTPリクエストを省略する
+        cached_models = self._load_model_cache(self.api_host)
+        if cached_models is not None and self._model_in_list(model_name, cached_models):
+            return True
+        # キャッシュに目的のモデルがない場合は一度だけ再取得する
+
         try:
             # モデル一覧を取得
-            print("利用可能なモデルを確認中...")
-            models_response = ollama.list()
-            
+            logger.debug("利用可能なモデルを確認中...")
+            models_response = self.client.list()
+
             # デバッグ情報
-            print(f"Ollama応答の型: {type(models_response)}")
+            logger.debug("Ollama応答の型: %s", type(models_response))
             
             # 応答形式によって処理を分岐
             available_models = []
             
-            if isinstance(models_response, dict) and 'models' in models_response:
+            if hasattr(models_response, 'models'):
+                # 型付き応答: ollama 0.4以降のクライアントはオブジェクトを返す
+                available_models = [
+                    getattr(model, 'model', None) or getattr(model, 'name', '')
+                    for model in models_response.models
+                ]
+            elif isinstance(models_response, dict) and 'models' in models_response:
                 # 旧形式: {'models': [{'name': 'model1'}, {'name': 'model2'}]}
                 available_models = [model['name'] for model in models_response.get('models', [])]
             elif isinstance(models_response, list):
@@ -128,10 +360,10 @@ class OllamaProcessor:
                 available_models = [model.get('name', '') for model in models_response if 'name' in model]
             else:
                 # その他の形式: キーをチェックして対応
-                print(f"予期しない応答形式: {models_response}")
+                logger.debug("予期しない応答形式: %s", models_response)
                 if isinstance(models_response, dict):
                     # キーを出力して確認
-                    print(f"応答のキー: {list(models_response.keys())}")
+                    logger.debug("応答のキー: %s", list(models_response.keys()))
                     
                     # 適切なキーを探す
                     for key in models_response.keys():
@@ -141,13 +373,15 @@ class OllamaProcessor:
                                 break
             
             # 利用可能なモデルを表示
-            print(f"利用可能なモデル: {available_models}")
-            
+            logger.debug("利用可能なモデル: %s", available_models)
+
+            # 次回の起動時に再利用できるようキャッシュへ保存
+            self._save_model_cache(self.api_host, available_models)
+
             # 完全一致または前方一致でチェック
-            for available in available_models:
-                if model_name == available or available.startswith(f"{model_name}:"):
-                    return True
-            
+            if self._model_in_list(model_name, available_models):
+                return True
+
             print(f"警告: モデル '{model_name}' はローカルにインストールされていません。")
             
             # モデルの自動ダウンロードを確認
@@ -155,7 +389,7 @@ class OllamaProcessor:
                 print(f"モデル '{model_name}' をダウンロード中...")
                 with tqdm(total=100, desc=f"モデル {model_name} をダウンロード中") as pbar:
                     # ダウンロード開始
-                    ollama.pull(model_name)
+                    self.client.pull(model_name)
                     # ダウンロードが完了したらプログレスバーを100%にする
                     pbar.update(100)
                 return True
@@ -170,53 +404,71 @@ class OllamaProcessor:
             print("Ollamaがインストールされ、サービスが実行されていることを確認してください。")
             return False
     
-    def process_item(self, model_name: str, item: Dict[str, Any], retry_attempts: int) -> Optional[Dict[str, Any]]:
+    def _build_messages(self, item: Dict[str, Any]) -> Optional[Sequence[Dict[str, str]]]:
+        """アイテムからOllamaへ送るメッセージ列を組み立てる（送れない形式ならNone）"""
+        if self._multi_turn and len(item['role']) > 1:
+            # マルチターン会話の場合
+            # Ollamaの仕様に合わせてroleを変換（userかassistant）
+            messages = [
+                {'role': 'user' if role == 'user' else 'assistant', 'content': text}
+                for role, text in zip(item['role'], item['text'])
+            ]
+
+            # 最後のメッセージがユーザーからでない場合は処理をスキップ
+            if not messages or messages[-1]['role'] != 'user':
+                logger.warning("ID %s の最後のメッセージがユーザーからではありません。スキップします。",
+                               item.get('id', '不明'))
+                return None
+            return messages
+
+        # 単一ターンの場合（大半の入力はこちら。listよりタプルの方が確保が軽い）
+        return ({'role': 'user', 'content': item['text'][0]},)
+
+    def _chat_body(self, model_name: str, messages: Sequence[Dict[str, str]]) -> bytes:
+        """チャットリクエストのボディを組み立てる
+
+        モデル名・オプション・stream指定は全リクエストで同一なので、
+        その部分は一度だけエンコードした断片を使い回し、リクエストごとには
+        messagesのバイト列を連結するだけにする。
+        """
+        prefix = self._chat_payload_prefix
+        if prefix is None or model_name != self._chat_payload_model:
+            # 末尾の '}' を落とした断片をモデル名ごとにキャッシュする
+            prefix = _json_bytes(
+                {"model": model_name, "options": self._request_options, "stream": False}
+            )[:-1]
+            self._chat_payload_model = model_name
+            self._chat_payload_prefix = prefix
+        return prefix + b',"messages":' + _json_bytes(messages) + b'}'
+
+    async def process_item(self, model_name: str, item: Dict[str, Any], retry_attempts: int,
+                           client: Optional[httpx.AsyncClient] = None) -> Optional[Dict[str, Any]]:
         """Ollamaを使用して単一のアイテムを処理する"""
-        if not self.validate_input(item):
-            print(f"警告: 無効な形式のアイテムをスキップします: {item}")
-            return None
-        
-        # リクエストオプションを取得
-        request_options = self.ollama_settings.get("request_options", {})
-        
-        # マルチターン会話の有効/無効を確認
-        multi_turn_enabled = self.config.get("multi_turn_conversation", {}).get("enabled", False)
+        if client is None:
+            client = self.async_clients[0]
+
+        # エラーパスで何度もdictを引かないよう、IDは先に取り出しておく
+        # （入力の形式検証はリーダー側で済んでいる前提）
+        item_id = item.get('id', '不明')
         
+        # メッセージ列はリトライで変わらないので、ループの外で一度だけ組み立てる
+        messages = self._build_messages(item)
+        if messages is None:
+            return None
+
         # リトライロジック
         for attempt in range(retry_attempts):
             try:
-                if multi_turn_enabled and len(item['role']) > 1:
-                    # マルチターン会話の場合
-                    messages = []
-                    for i, role in enumerate(item['role']):
-                        if i < len(item['text']):
-                            # Ollamaの仕様に合わせてroleを変換（userかassistant）
-                            ollama_role = "assistant" if role != "user" else "user"
-                            messages.append({
-                                'role': ollama_role,
-                                'content': item['text'][i]
-                            })
-                    
-                    # 最後のメッセージがユーザーからでない場合は処理をスキップ
-                    if not messages or messages[-1]['role'] != "user":
-                        print(f"警告: ID {item.get('id', '不明')} の最後のメッセージがユーザーからではありません。スキップします。")
-                        return None
-                else:
-                    # 単一ターンの場合
-                    messages = [{
-                        'role': 'user',
-                        'content': item['text'][0]
-                    }]
-                
-                # Ollamaでチャット応答を取得
-                response = ollama.chat(
-                    model=model_name,
-                    messages=messages,
-                    options=request_options
-                )
-                
+                # Ollamaでチャット応答を取得（セマフォで同時リクエスト数を制限）
+                async with self._sem:
+                    response = await client.post(
+                        "/api/chat",
+                        content=self._chat_body(model_name, messages)
+                    )
+                    response.raise_for_status()
+
                 # モデルからの応答テキストを取得
-                model_response = response['message']['content']
+                model_response = _json_loads(response.content)['message']['content']
                 
                 # 結果を適切な形式で保存
                 result = {
@@ -228,66 +480,210 @@ class OllamaProcessor:
                 return result
                 
             except Exception as e:
-                print(f"エラー (試行 {attempt+1}/{retry_attempts}): ID {item.get('id', '不明')} の処理中にエラーが発生しました: {e}")
+                # リトライする価値があるのは一時的なエラー
+                # （接続断・タイムアウト・5xx・429）だけで、
+                # それ以外（4xx等）は再試行しても成功しないため即座に諦める
+                if isinstance(e, httpx.HTTPStatusError):
+                    status = e.response.status_code
+                else:
+                    status = getattr(e, 'status_code', None)
+                transient = (
+                    isinstance(e, (httpx.TimeoutException, httpx.TransportError))
+                    or (status is not None and (status >= 500 or status == 429))
+                )
+                if not transient:
+                    logger.warning("ID %s の処理中に恒久的なエラーが発生しました。スキップします: %s", item_id, e)
+                    return None
+
+                logger.warning("試行 %d/%d: ID %s の処理中にエラーが発生しました: %s",
+                               attempt + 1, retry_attempts, item_id, e)
                 if attempt < retry_attempts - 1:
-                    # リトライ前に少し待機
-                    time.sleep(2)
+                    # 指数バックオフ＋ジッタで待機
+                    # （同時に失敗したリクエストが一斉に再送して輻輳するのを避ける）
+                    await asyncio.sleep(min(30, (2 ** attempt) + random.uniform(0, 1)))
         
-        print(f"警告: ID {item.get('id', '不明')} の最大リトライ回数に達しました。スキップします。")
+        logger.warning("ID %s の最大リトライ回数に達しました。スキップします。", item_id)
         return None
     
-    def process_batch(self, model_name: str, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """バッチ処理を行う"""
-        results = []
-        retry_attempts = self.script_settings.get("retry_attempts", 3)
-        
-        for item in tqdm(batch, desc="バッチ処理中"):
-            result = self.process_item(model_name, item, retry_attempts)
-            if result:
-                results.append(result)
-        
-        return results
-    
-    def process_all(self, model_name: str, input_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """全データをバッチに分けて処理する"""
-        results = []
+    async def _process_stream_async(self, model_name: str, items: Iterator[Dict[str, Any]], output_path: str) -> Tuple[int, int]:
+        """読み込み・推論・書き込みの3段パイプラインで入力ストリームを処理する
+
+        リーダーが入力をキューへ流し、複数のワーカーがOllamaへの
+        リクエストを並行して行い、ライターが完了した結果から順に
+        書き出す。各段が重なって動くため、GPUが推論している間も
+        ファイルI/Oが進む。
+        """
         batch_size = self.script_settings.get("batch_size", 10)
-        
-        # 全体の進行状況を表示
-        total_batches = (len(input_data) + batch_size - 1) // batch_size
-        with tqdm(total=len(input_data), desc=f"モデル {model_name} で処理中") as pbar:
-            # データをバッチに分割して処理
-            for i in range(0, len(input_data), batch_size):
-                batch = input_data[i:i+batch_size]
-                batch_results = self.process_batch(model_name, batch)
-                results.extend(batch_results)
-                pbar.update(len(batch))
-        
-        return results
+        retry_attempts = self.script_settings.get("retry_attempts", 3)
+
+        # ワーカー数は同時リクエスト数の上限に合わせる
+        # （サーバー側のOLLAMA_NUM_PARALLELと揃えると無駄がない）
+        num_workers = self.max_parallel
+
+        # キューを有界にして、読み込みが推論を追い越しすぎないようにする
+        reader_q: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 4)
+        writer_q: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 4)
+
+        total = 0
+        processed = 0
+
+        # 既存の出力に含まれるIDは処理済みとしてスキップする
+        # （中断したジョブを同じコマンドで再開できる）
+        done_ids = self._load_done_ids(output_path)
+        if done_ids:
+            print(f"{len(done_ids)}件の処理済みデータを検出しました。未処理分のみ処理します。")
+
+        # 進捗表示は1本のバーだけをライターから更新する
+        # （再描画間隔を空けて端末I/Oとロック取得を減らす）
+        pbar = tqdm(desc=f"モデル {model_name} で処理中", unit="件", mininterval=0.5)
+
+        # ライター停止用のセンチネル（Noneは「失敗してスキップ」を表すため別物にする）
+        writer_done = object()
+
+        # 長さが近いリクエストを同じ並行ウェーブに載せると、サーバー側の
+        # 継続バッチングで短いリクエストが長いものの完了を待つ無駄が減る。
+        # 全体ソートはストリーミングと両立しないので、ウィンドウ単位でソートする
+        sort_window = max(batch_size * num_workers, batch_size)
+
+        async def reader() -> None:
+            nonlocal total
+            window: List[Dict[str, Any]] = []
+
+            async def flush_window() -> None:
+                window.sort(key=self._prompt_length)
+                for it in window:
+                    await reader_q.put(it)
+                window.clear()
+
+            for item in items:
+                # JSONとしては正しいがオブジェクトでない行（配列やスカラー）は
+                # id照合より前に弾く（validate_inputも辞書以外では例外になる）
+                if not isinstance(item, dict):
+                    logger.warning("無効な形式のアイテムをスキップします: %s", item)
+                    continue
+                if item.get('id') in done_ids:
+                    continue
+                # 無効なアイテムはワーカーへ渡す前にここで弾く
+                # （タスク投入とセマフォ取得のコストをかけない）
+                if not self.validate_input(item):
+                    logger.warning("無効な形式のアイテムをスキップします: %s", item)
+                    continue
+                total += 1
+                window.append(item)
+                if len(window) >= sort_window:
+                    await flush_window()
+            await flush_window()
+            # ワーカーの数だけ終了センチネルを流す
+            for _ in range(num_workers):
+                await reader_q.put(None)
+
+        async def worker(worker_idx: int) -> None:
+            # ワーカーをラウンドロビンで各ホストのクライアントへ割り当てる
+            client = self.async_clients[worker_idx % len(self.async_clients)]
+            while True:
+                item = await reader_q.get()
+                if item is None:
+                    break
+                # 失敗（None）もライターへ流し、進捗の更新は1箇所にまとめる
+                await writer_q.put(await self.process_item(model_name, item, retry_attempts, client))
+
+        async def writer() -> None:
+            nonlocal processed
+            # 出力ディレクトリが存在しない場合は作成
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            # 強制終了などで末尾に改行のない壊れた行が残っている場合、
+            # 新しい結果が連結されて巻き添えにならないよう改行で区切っておく
+            needs_newline = False
+            try:
+                with open(output_path, 'rb') as rf:
+                    rf.seek(-1, os.SEEK_END)
+                    needs_newline = rf.read(1) != b'\n'
+            except (OSError, ValueError):
+                pass
+            # 追記モードで開き、完了した結果を逐次永続化する
+            with open(output_path, 'ab', buffering=1 << 20) as f:
+                if needs_newline:
+                    f.write(b'\n')
+                # 書き込みはWRITE_CHUNK_LINES行ずつまとめてwritelinesで行うが、
+                # キューが空になった時点でも書き出して中断時の損失を抑える
+                pending: List[bytes] = []
+                while True:
+                    result = await writer_q.get()
+                    if result is writer_done:
+                        break
+                    pbar.update(1)
+                    if result is None:
+                        # 失敗してスキップされたアイテム（進捗のみ進める）
+                        continue
+                    pending.append(self._dump_line(result))
+                    processed += 1
+                    if len(pending) >= WRITE_CHUNK_LINES or writer_q.empty():
+                        f.writelines(pending)
+                        pending.clear()
+                        f.flush()
+                if pending:
+                    f.writelines(pending)
+
+        async def produce() -> None:
+            # リーダーと全ワーカーが終わったらライターへ終了センチネルを送る
+            await asyncio.gather(reader(), *[worker(i) for i in range(num_workers)])
+            await writer_q.put(writer_done)
+
+        try:
+            # ライターも同じgatherに入れ、書き込み失敗（出力先が
+            # 書き込めない等）の例外が即座に伝播するようにする
+            await asyncio.gather(produce(), writer())
+        finally:
+            pbar.close()
+
+        return processed, total
+
+    def process_stream(self, model_name: str, items: Iterator[Dict[str, Any]], output_path: str) -> Tuple[int, int]:
+        """入力ストリーム全体を処理し、(処理成功件数, 読み込み件数) を返す"""
+        return asyncio.run(self._process_stream_async(model_name, items, output_path))
     
+    def _lower_process_priority(self) -> None:
+        """同一マシンで動くOllamaサーバーとCPUを取り合わないよう自プロセスの優先度を下げる
+
+        クライアント側のパースや書き込みは多少遅くなるが、GPUへ供給する
+        推論スレッドの応答性が保たれ、全体のスループットには有利に働く。
+        """
+        if not self.script_settings.get("lower_priority", True):
+            return
+        try:
+            os.nice(5)
+        except (AttributeError, OSError):
+            pass
+
+        # restrict_affinityを有効にすると自プロセスを前半のコアに限定する
+        # （Linuxのみ。さらに強くサーバー側へCPUを譲りたい場合向け）
+        if self.script_settings.get("restrict_affinity", False) and hasattr(os, "sched_setaffinity"):
+            try:
+                cores = sorted(os.sched_getaffinity(0))
+                os.sched_setaffinity(0, set(cores[:max(1, len(cores) // 2)]))
+            except OSError:
+                pass
+
     def run(self, model_name: str, input_path: str, output_path: str) -> None:
         """メイン処理を実行する"""
+        # ローカルのOllamaサーバーにCPUを譲る
+        self._lower_process_priority()
+
         # モデルが利用可能かチェック
         if not self.check_model_availability(model_name):
             print(f"エラー: モデル '{model_name}' が利用できません。")
             sys.exit(1)
         
-        # 入力ファイルを読み込む
-        print(f"入力ファイル {input_path} を読み込んでいます...")
-        input_data = self.read_jsonl(input_path)
-        print(f"{len(input_data)}件のデータを読み込みました")
-        
-        if not input_data:
-            print("警告: 入力データが空です。処理を終了します。")
+        # 入力ファイルをストリーミングで読み込みながら処理し、結果を逐次保存する
+        print(f"入力ファイル {input_path} を処理しています...")
+        processed, total = self.process_stream(model_name, self.iter_jsonl(input_path), output_path)
+
+        if total == 0:
+            print("処理対象のデータがありません（入力が空か、すべて処理済みです）。")
             sys.exit(0)
-        
-        # Ollamaで処理
-        results = self.process_all(model_name, input_data)
-        print(f"{len(results)}/{len(input_data)}件のデータの処理が完了しました")
-        
-        # 結果を保存
-        print(f"結果を {output_path} に保存しています...")
-        self.write_jsonl(output_path, results)
+
+        print(f"{processed}/{total}件のデータの処理が完了しました")
+        print(f"結果を {output_path} に保存しました")
         print("処理が完了しました！")
 
 
@@ -297,11 +693,16 @@ def main():
     parser.add_argument('--input', type=str, required=True, help='入力JSONLファイルのパス')
     parser.add_argument('--output', type=str, required=True, help='出力JSONLファイルのパス')
     parser.add_argument('--config', type=str, default='template_config.json', help='設定ファイルのパス（デフォルト: template_config.json）')
-    
+    parser.add_argument('--max-parallel', type=int, default=None, help='同時に送信するリクエスト数の上限（設定ファイルのmax_parallel_requestsを上書き）')
+    parser.add_argument('--verbose', action='store_true', help='デバッグログを表示する')
+
     args = parser.parse_args()
-    
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
+
     # プロセッサを初期化して実行
-    processor = OllamaProcessor(args.config)
+    processor = OllamaProcessor(args.config, max_parallel=args.max_parallel)
     processor.run(args.model, args.input, args.output)
 
 